@@ -3,22 +3,25 @@
 ------------------------------------------------------------------------------
  Author: Colin M. Skinner
  Date Created: 2024-08-02
- Last Modified: 2024-08-10
+ Last Modified: 2026-10-15
  Description: A collection of functions for analyzing the feature selection
               of methylation clocks. This script enables analysis of CpG site 
               feature importance, correlation, heteroscedasticity, and group 
               comparison statistics. The functions are designed for import into 
               a Jupyter Notebook or other interactive environment.
 
- Dependencies:  pandas, numpy, scipy, utils.data_processing (custom module)
+ Dependencies:  pandas, numpy, scipy, joblib, utils.data_processing (custom module),
+                numba (optional, for `get_stats(..., use_numba=True)`)
  Usage: Import `feature_selection_analyses.py` into a Jupyter Notebook or other
         Python environment and call the desired functions for feature analysis.
 
 
  Notes: - The script provides multiple analysis functions, including:
+        - `AgeCache`: Precomputes the age terms reused across regressions on one cohort.
         - `get_stats`: Computes regression statistics for CpG data.
         - `get_tvals`: Calculates t-values to assess feature significance.
         - `model_corrs`: Correlates model CpGs with reference data.
+        - `model_corrs_many`: Runs `model_corrs` for several models, sharing the regression work.
         - `normalized_importance`: Calculates normalized feature importances.
         - `het_r`: Measures noise correlation with age.
         - `u_test`: Performs Mann-Whitney U test for two sample groups.
@@ -28,11 +31,98 @@
 
 import pandas as pd 
 import numpy as np 
-from scipy import stats
+from scipy.special import ndtr
+from scipy.stats import mannwhitneyu, rankdata
+from joblib import Parallel, delayed, effective_n_jobs
 from utils.data_processing import prep_model
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
-def get_stats(dataset, meta):
+
+def _as_f32_matrix(df):
+    """
+    Return the values of `df` as a C-contiguous float32 array. Beta values lie in [0, 1],
+    so single precision is ample for storage and halves the memory of the extracted matrix.
+    The regressions center it in double precision, since sums of squares lose too many
+    digits in float32 for CpGs that track age closely.
+    """
+    return np.ascontiguousarray(df.to_numpy(dtype=np.float32))
+
+
+class AgeCache:
+    """
+    Precomputed age terms shared by the regression helpers.
+
+    Build once per cohort and pass in place of `meta` (or `ages` for `het_r`) when
+    evaluating many models on the same samples, so the age vector is only converted
+    and centered once.
+
+    Parameters:
+    meta (pd.DataFrame): A DataFrame containing metadata with an 'age' column containing sample ages.
+    """
+
+    def __init__(self, meta):
+        self.x = meta.age.to_numpy(dtype=float)
+        self.n = len(self.x)
+        self.xmean = self.x.mean()
+        self.x_centered = self.x - self.xmean
+        self.Sxx = (self.x_centered * self.x_centered).sum()
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath={'contract', 'reassoc'})
+    def _stats_kernel(Y, x_centered, Sxx):
+        """
+        Numba version of the `get_stats` regression, threaded over blocks of CpG columns.
+        `Y` is C-contiguous, so each thread walks the rows of its block and accumulates the
+        per-column sums in float64, keeping every read contiguous. NaNs propagate as in NumPy.
+        """
+        n, n_feat = Y.shape
+        block = 256
+        means = np.zeros(n_feat)
+        Sxy = np.zeros(n_feat)
+        Syy = np.zeros(n_feat)
+        
+        for b in prange((n_feat + block - 1) // block):
+            start = b * block
+            stop = min(start + block, n_feat)
+            
+            for i in range(n):
+                for j in range(start, stop):
+                    means[j] += Y[i, j]
+            for j in range(start, stop):
+                means[j] /= n
+                
+            for i in range(n):
+                for j in range(start, stop):
+                    d = Y[i, j] - means[j]
+                    Sxy[j] += x_centered[i] * d
+                    Syy[j] += d * d
+        
+        rs = np.empty(n_feat)
+        stderrs = np.empty(n_feat)
+        
+        for j in range(n_feat):
+            # As in scipy.stats.linregress, r is 0 for a zero-variance column and is clipped to [-1, 1]
+            denom = Sxx * Syy[j]
+            if denom == 0:
+                r = 0.0
+            else:
+                r = Sxy[j] / np.sqrt(denom)
+                if r > 1.0:
+                    r = 1.0
+                elif r < -1.0:
+                    r = -1.0
+            rs[j] = r
+            stderrs[j] = np.sqrt((1 - r * r) * Syy[j] / (Sxx * (n - 2)))
+            
+        return rs, stderrs
+
+
+def get_stats(dataset, meta, use_numba=False):
     """
     Compute regression statistics for each column in the dataset.
 
@@ -43,23 +133,36 @@ def get_stats(dataset, meta):
     Parameters:
     dataset (pd.DataFrame): A DataFrame where each column contains CpG site data
                             for regression analysis.
-    meta (pd.DataFrame): A DataFrame containing metadata with an 'age' column containing sample ages.
+    meta (pd.DataFrame or AgeCache): A DataFrame containing metadata with an 'age' column containing
+                                     sample ages, or an AgeCache built from it.
+    use_numba (bool): Run the regressions in a parallel Numba kernel instead of NumPy/BLAS.
+                      Useful on platforms without a multithreaded BLAS. Requires numba.
 
     Returns:
-    tuple: A tuple containing two lists:
-        - rs (list of float): The correlation coefficients (r-values) from the regression.
-        - stderrs (list of float): The standard errors of the regression slopes.
+    tuple: A tuple containing two arrays:
+        - rs (np.ndarray): The correlation coefficients (r-values) from the regression.
+        - stderrs (np.ndarray): The standard errors of the regression slopes.
     """
-    rs = []
-    stderrs = []
-
-    for column in dataset:
-        # Perform linear regression between age and the current column
-        regression = stats.linregress(meta.age.astype(float), dataset[column].astype(float))
-        slope, intercept, rvalue, pvalue, stderr = regression
-        rs.append(rvalue)
-        stderrs.append(stderr)
-        
+    ages = meta if isinstance(meta, AgeCache) else AgeCache(meta)
+    Y = _as_f32_matrix(dataset)
+
+    if use_numba:
+        if njit is None:
+            raise ImportError("get_stats(use_numba=True) requires the numba package")
+        return _stats_kernel(Y, ages.x_centered, ages.Sxx)
+
+    # Center the CpG columns once (in float64), then regress every column on age in one pass
+    Y_centered = Y - Y.mean(axis=0, dtype=np.float64)
+    Syy = (Y_centered * Y_centered).sum(axis=0)
+    Sxy = ages.x_centered @ Y_centered
+
+    # As in scipy.stats.linregress, r is 0 for a zero-variance column and is clipped to [-1, 1]
+    denom = ages.Sxx * Syy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rs = np.where(denom == 0, 0.0, Sxy / np.sqrt(denom))
+    rs = np.clip(rs, -1, 1)
+    stderrs = np.sqrt((1 - rs ** 2) * Syy / (ages.Sxx * (ages.n - 2)))
+
     return rs, stderrs
 
 def get_tvals(weights, stderrs):
@@ -71,17 +174,13 @@ def get_tvals(weights, stderrs):
     feature's weight.
 
     Parameters:
-    weights (list of float): A list of feature weights.
-    stderrs (list of float): A list of standard errors corresponding to each feature weight.
+    weights (list or np.ndarray of float): Feature weights.
+    stderrs (list or np.ndarray of float): Standard errors corresponding to each feature weight.
 
     Returns:
     list of float: A list of t-values for each feature.
     """
-    tvals = []
-    for i in range(len(weights)):
-        tvals.append(weights[i] / stderrs[i])
-        
-    return tvals
+    return (np.asarray(weights) / np.asarray(stderrs)).tolist()
 
 def model_corrs(model, ref_data, meta):
     """
@@ -95,7 +194,8 @@ def model_corrs(model, ref_data, meta):
     model (pd.DataFrame): DataFrame containing CpGs and their associated weights for the given model.
                          The DataFrame must have columns 'CpG' and 'Weight'.
     ref_data (pd.DataFrame): DataFrame containing the reference dataset with sample beta values.
-    meta (pd.DataFrame): DataFrame containing metadata with an 'age' column containing sample ages for computing correlations.
+    meta (pd.DataFrame or AgeCache): DataFrame containing metadata with an 'age' column containing sample ages for
+                                     computing correlations, or an AgeCache built from it.
 
     Returns:
     pd.DataFrame: DataFrame containing the model CpGs, model weights, age-correlations (r), t-statistics (t),
@@ -103,37 +203,85 @@ def model_corrs(model, ref_data, meta):
     list: List of CpG sites present in the model but missing from the reference dataset.
     """
 
-    # Get the intersection of the CpGs between the model and the reference data
-    intersect = list(set(ref_data.columns) & set(model.CpG))
+    # Get the sorted intersection of the CpGs between the model and the reference data
+    model_cpgs = pd.Index(model.CpG)
+    intersect = model_cpgs.intersection(ref_data.columns).sort_values()
     
-    # Identify missing CpGs and sort them
-    missing = sorted(list(set(model.CpG) - set(intersect)))
+    # Identify missing CpGs (Index.difference returns them sorted)
+    missing = model_cpgs.difference(ref_data.columns).tolist()
     
-    # Sort the intersection to keep the lists synced
-    intersect.sort()
-    
-    # Filter the model data to only include CpGs in the intersection
-    data = model.loc[model.CpG.isin(intersect)]
-    
-    # Extract the CpG values from the reference data for the intersection
-    combined = ref_data[intersect]
+    # Extract the reference beta values for the intersection by column position
+    combined = ref_data.iloc[:, ref_data.columns.get_indexer(intersect)]
     
     # Compute age-correlations and standard errors
-    model_rs, stderrs = get_stats(combined, meta)
+    ages = meta if isinstance(meta, AgeCache) else AgeCache(meta)
+    model_rs, stderrs = get_stats(combined, ages)
+    
+    return _corrs_frame(model, intersect, model_rs, stderrs), missing
+
+
+def _corrs_frame(model, intersect, model_rs, stderrs):
+    """
+    Assemble the `model_corrs` results DataFrame from the model weights and the age-regression
+    statistics of the CpGs in `intersect` (in that order).
+    """
+    # Align the model weights on the intersection
+    weights = model.set_index('CpG').Weight.loc[intersect].to_numpy()
     
     # Compute the feature importances based on t-statistics
-    importances = get_tvals(model.Weight.tolist(), stderrs)
+    importances = get_tvals(weights, stderrs)
     
     # Create a DataFrame with the results
     cg_corrs = pd.DataFrame({
-        'CpG': combined.columns.tolist(),
-        'Weight': model.Weight.tolist(),
+        'CpG': intersect.tolist(),
+        'Weight': weights,
         'r': model_rs,
         't': importances
     })
     cg_corrs['R2'] = cg_corrs.r ** 2 
     
-    return cg_corrs, missing
+    return cg_corrs
+
+
+def model_corrs_many(models, ref_data, meta):
+    """
+    Run `model_corrs` for several models against the same reference dataset.
+
+    The age-regression statistics are computed once over the union of the models' CpGs and then
+    sliced per model, so CpGs shared between clocks (and the age preprocessing) are only processed once.
+
+    Parameters:
+    models (dict): Mapping of model name (e.g., Hannum, PhenoAge) to a DataFrame with columns 'CpG' and 'Weight'.
+    ref_data (pd.DataFrame): DataFrame containing the reference dataset with sample beta values.
+    meta (pd.DataFrame or AgeCache): DataFrame containing metadata with an 'age' column containing sample ages for
+                                     computing correlations, or an AgeCache built from it.
+
+    Returns:
+    dict: Mapping of each model name to the (cg_corrs, missing) tuple returned by `model_corrs`.
+    """
+    
+    # Get the sorted intersection of each model's CpGs with the reference data
+    model_cpgs = {name: pd.Index(model.CpG) for name, model in models.items()}
+    intersects = {name: cpgs.intersection(ref_data.columns).sort_values() for name, cpgs in model_cpgs.items()}
+    
+    # Compute age-correlations and standard errors once for the union of all models' CpGs
+    union = pd.Index([], dtype=object)
+    for intersect in intersects.values():
+        union = union.union(intersect)
+    
+    ages = meta if isinstance(meta, AgeCache) else AgeCache(meta)
+    union_rs, union_stderrs = get_stats(ref_data.iloc[:, ref_data.columns.get_indexer(union)], ages)
+    
+    results = {}
+    for name, model in models.items():
+        positions = union.get_indexer(intersects[name])
+        missing = model_cpgs[name].difference(ref_data.columns).tolist()
+        results[name] = (
+            _corrs_frame(model, intersects[name], union_rs[positions], union_stderrs[positions]),
+            missing,
+        )
+    
+    return results
 
 def normalized_importance(data):
 
@@ -148,12 +296,51 @@ def normalized_importance(data):
 
     """
     
-    importances = abs(data.t)/abs(data.t).max()
+    abs_t = np.abs(data['t'].to_numpy())
+    
+    # CpGs with missing reference beta values have a NaN t; skip them when taking the
+    # maximum, as the pandas max() did (and, like pandas, divide inf/inf quietly)
+    with np.errstate(invalid='ignore'):
+        importances = abs_t / np.nanmax(abs_t)
+    
+    return pd.Series(importances, index=data.index, name='t')
+
+
+def _column_chunks(n_cols, n_jobs):
+    """
+    Split the column positions 0..n_cols-1 into one contiguous chunk per joblib worker.
+    """
+    n_chunks = max(min(effective_n_jobs(n_jobs), n_cols), 1)
     
-    return importances
+    return np.array_split(np.arange(n_cols), n_chunks)
 
 
-def het_r(data, model, ages):
+def _het_r_batch(Y, ages):
+    """
+    Compute the het_r R-squared values for every column of the beta value matrix `Y`
+    (samples x CpGs) against the AgeCache `ages`.
+    """
+    a_centered = ages.x_centered
+    
+    # Regress every predictor on age at once (in float64); only the slope is needed, since
+    # in centered coordinates the fitted line passes through the origin
+    Y_centered = Y - Y.mean(axis=0, dtype=np.float64)
+    slope = (a_centered @ Y_centered) / ages.Sxx
+    
+    # Calculate the absolute residuals
+    abs_resids = np.abs(np.outer(a_centered, slope) - Y_centered)
+    
+    # Correlate the residuals for each predictor with age (only r is used, so no full regression)
+    R_centered = abs_resids - abs_resids.mean(axis=0)
+    # As in scipy.stats.linregress, r is 0 when the residuals have zero variance
+    denom = ages.Sxx * (R_centered * R_centered).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r_resid = np.where(denom == 0, 0.0, (a_centered @ R_centered) / np.sqrt(denom))
+    
+    return r_resid ** 2
+
+
+def het_r(data, model, ages, n_jobs=1):
     """
     Measure the noise (heteroscedasticity) with age for a given predictor by calculating the residuals 
     for the age-correlation and then regressing those residuals on age.
@@ -162,42 +349,66 @@ def het_r(data, model, ages):
     data (pd.DataFrame): Processed beta values for the CpG selection of a given model (e.g., Hannum, PhenoAge, DunedinPACE, etc.).
     model (pd.DataFrame): DataFrame containing CpGs and their associated weights for the given model.
                          The DataFrame must have columns 'CpG' and 'Weight'.
-    ages (list): List of sample ages corresponding to the beta values in `data`.
+    ages (list or AgeCache): List of sample ages corresponding to the beta values in `data`, or an AgeCache
+                             built from the same samples.
+    n_jobs (int): Number of joblib threads to split the CpG columns across (-1 uses all cores).
 
     Returns:
     list: List of R-squared values for the correlation between age and noise for each CpG in the given model.
     """
     
-    # Get the intersection of the CpGs between the model and the data
-    intersect = list(set(data.columns) & set(model.CpG))
+    # Get the sorted intersection of the CpGs between the model and the data
+    intersect = pd.Index(model.CpG).intersection(data.columns).sort_values()
     
-    # Sort the intersection to keep the lists synced
-    intersect.sort()
+    temp_data = data.iloc[:, data.columns.get_indexer(intersect)]
+    Y = _as_f32_matrix(temp_data)
+    if not isinstance(ages, AgeCache):
+        ages = AgeCache(pd.DataFrame({'age': ages}))
     
-    temp_data = data[intersect]
-    het_rs = []
+    # Each thread regresses a contiguous slice of the CpG columns
+    chunks = _column_chunks(Y.shape[1], n_jobs)
+    het_rs = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(_het_r_batch)(Y[:, chunk], ages) for chunk in chunks
+    )
     
-    for cg in temp_data.columns:
-        # Regress a given predictor on age
-        regression = stats.linregress(ages.astype(float), temp_data[cg].tolist())
-        slope, intercept, rvalue, pvalue, stderr = regression
-        
-        preds = ages * slope + intercept
-        actuals = temp_data[cg].tolist()
-        
-        # Calculate the absolute residuals
-        abs_resids = abs(preds - actuals)
-        
-        # Regress the residuals for the predictor on age
-        regression = stats.linregress(ages.astype(float), abs_resids)
-        slope, intercept, rvalue, pvalue, stderr = regression
-        
-        het_rs.append(rvalue * rvalue)
-        
-    return het_rs
+    return np.concatenate(het_rs).tolist()
+
+
+def _u_test_batch(A, B):
+    """
+    Compute the Mann-Whitney U statistics (for `A`) and two-sided p-values for every
+    column of the beta value matrices `A` and `B` (samples x CpGs).
+    """
+    n1, n2 = len(A), len(B)
+    n = n1 + n2
+    C = np.vstack([A, B])
+    
+    # Rank each CpG jointly across both groups to get every U statistic at once
+    ranks = rankdata(C, axis=0)
+    u_stats = ranks[:n1].sum(axis=0) - n1 * (n1 + 1) / 2
+    
+    # Tie correction: a tie group of size t adds t**3 - t, i.e. t**2 - 1 per member,
+    # where t = 2 * (average rank - minimum rank) + 1
+    t = 2 * (ranks - rankdata(C, method='min', axis=0)) + 1
+    tie_term = (t * t - 1).sum(axis=0)
+    
+    # Two-sided normal approximation with continuity correction (scipy's asymptotic method)
+    U = np.maximum(u_stats, n1 * n2 - u_stats)
+    sigma = np.sqrt(n1 * n2 / 12 * (n + 1 - tie_term / (n * (n - 1))))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (U - n1 * n2 / 2 - 0.5) / sigma
+    p_vals = np.clip(2 * ndtr(-z), 0, 1)
+    
+    # Small groups without ties use the exact distribution, as mannwhitneyu does by default
+    if n1 <= 8 or n2 <= 8:
+        exact = tie_term == 0
+        if exact.any():
+            p_vals[exact] = mannwhitneyu(A[:, exact], B[:, exact], axis=0, method='exact').pvalue
+    
+    return u_stats, p_vals
 
 
-def u_test(model, data1, data2):
+def u_test(model, data1, data2, n_jobs=1):
     
     """
     Perform the Mann-Whitney U test on the beta values of two different sample groups 
@@ -222,6 +433,10 @@ def u_test(model, data1, data2):
     data2 : pandas.DataFrame
         A DataFrame containing the beta values for the second group of samples. Each row 
         represents a sample, and each column represents a CpG site.
+        
+    n_jobs : int, optional
+        Number of joblib threads to split the CpG sites across (-1 uses all cores).
+        Defaults to 1.
 
     Returns:
     --------
@@ -242,20 +457,18 @@ def u_test(model, data1, data2):
     
     """
         
-    from scipy.stats import mannwhitneyu
-    from math import log10
-    # Perform the Mann-Whitney U test
-    p_vals=[]
-    stats =[]
-    log_p=[]
+    cpgs = model.CpG[1:]
+    A = data1[cpgs].to_numpy(dtype=float)
+    B = data2[cpgs].to_numpy(dtype=float)
     
-    for cg in model.CpG[1:]:
-
-        
-        stat, p = mannwhitneyu(data1[cg].astype(float), data2[cg].astype(float))
-        
-        log_p += [-log10(p)]
-        stats+=[stat]
-        p_vals +=[p]
+    # Each thread tests a contiguous slice of the CpG columns
+    chunks = _column_chunks(A.shape[1], n_jobs)
+    results = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(_u_test_batch)(A[:, chunk], B[:, chunk]) for chunk in chunks
+    )
+    u_stats = np.concatenate([u for u, p in results])
+    p_vals = np.concatenate([p for u, p in results])
+    
+    log_p = -np.log10(p_vals)
         
-    return stats, p_vals, log_p
+    return u_stats.tolist(), p_vals.tolist(), log_p.tolist()